@@ -1,5 +1,8 @@
 import os
+import json
+import asyncio
 import uuid
+from functools import lru_cache
 from typing import List
 from fastapi import FastAPI, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
@@ -8,7 +11,9 @@ from dotenv import load_dotenv
 from backend.pdf_reader import extract_text_from_pdf
 from backend.processor import chunk_texts
 from backend.embeddings import EmbeddingManager
-from backend.vectorstore import FaissVectorStore
+from backend.vectorstore import FaissVectorStore, train_ivfpq
+from backend.query_cache import SemanticQueryCache
+from backend.query_batcher import QueryBatcher
 
 # -------------------- Google Gemini ----------------------
 import google.generativeai as genai
@@ -17,6 +22,7 @@ import google.generativeai as genai
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 genai.configure(api_key=GOOGLE_API_KEY)     # Configure Gemini API 
+GEMINI_MODEL = genai.GenerativeModel("gemini-2.5-flash")  # shared across requests
 
 # -------------------- App Setup --------------------------
 app = FastAPI(title="DocuMind Backend")
@@ -30,19 +36,108 @@ app.add_middleware(
 )
 
 # -------------------- Initialize Embeddings & Vectorstore --------------------
-embedding_manager = EmbeddingManager()
-EMB_DIM = embedding_manager.model.get_sentence_embedding_dimension()
-vector_store = FaissVectorStore(dim=EMB_DIM)
+EMBEDDING_BACKEND = os.getenv("DOCUMIND_EMBEDDING_BACKEND", "torch")  # torch | onnx
+embedding_manager = EmbeddingManager(backend=EMBEDDING_BACKEND)
+EMB_DIM = embedding_manager.dim
+INDEX_TYPE = os.getenv("DOCUMIND_INDEX_TYPE", "hnsw")  # flat | hnsw | ivfpq
+vector_store = FaissVectorStore(dim=EMB_DIM, index_type=INDEX_TYPE)
+
+query_cache = SemanticQueryCache(dim=EMB_DIM)  # answers reused for near-identical questions
+query_batcher = QueryBatcher(embedding_manager)  # coalesces concurrent query embeddings
+
+@app.on_event("startup")
+async def start_query_batcher():
+    """Launch the background task that embeds queued queries in batches."""
+    query_batcher.start()
 
 UPLOADED = {}  # store metadata of uploaded files
 
+# -------------------- Persistence ---------------------------------------------
+# Each save writes a new generation of files (<STORE_PATH>.<n>.*) and then atomically
+# points the manifest at it, so a crash mid-save leaves the previous generation intact.
+STORE_PATH = os.getenv("DOCUMIND_STORE_PATH", os.path.join("vector_store", "documind"))
+MANIFEST_PATH = STORE_PATH + ".manifest.json"
+store_generation = 0
+
+def _write_json_atomic(path, data):
+    """Write JSON to a temp file and rename it into place."""
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.replace(path + ".tmp", path)
+
+def _remove_generation(generation):
+    """Delete the files of an old store generation, if present."""
+    prefix = f"{STORE_PATH}.{generation}"
+    for suffix in (".faiss", ".meta", ".uploaded.json"):
+        if os.path.exists(prefix + suffix):
+            os.remove(prefix + suffix)
+
+def save_state():
+    """Persist the vector store and uploaded-file metadata so restarts skip re-ingestion."""
+    global store_generation
+    generation = store_generation + 1
+    prefix = f"{STORE_PATH}.{generation}"
+    vector_store.save(prefix)
+    _write_json_atomic(prefix + ".uploaded.json", UPLOADED)
+    _write_json_atomic(MANIFEST_PATH, {"generation": generation})  # commit point
+    _remove_generation(store_generation)
+    store_generation = generation
+
+@app.on_event("startup")
+def load_state():
+    """Restore a previously saved vector store and uploaded-file metadata, if any."""
+    global vector_store, store_generation
+    if not os.path.exists(MANIFEST_PATH):
+        return  # first run, nothing saved yet
+    with open(MANIFEST_PATH) as f:
+        store_generation = json.load(f)["generation"]
+    prefix = f"{STORE_PATH}.{store_generation}"
+    vector_store = FaissVectorStore.load(prefix)
+    with open(prefix + ".uploaded.json") as f:
+        UPLOADED.update(json.load(f))
+
+# -------------------- IVF-PQ Training -----------------------------------------
+ivfpq_build_task = None
+
+async def build_ivfpq_index():
+    """Train the IVF-PQ index in a worker thread so uploads and queries keep being served."""
+    vectors = vector_store.staged_vectors()
+    index = await asyncio.get_running_loop().run_in_executor(None, train_ivfpq, vectors)
+    vector_store.swap_in_ivfpq(index)
+    save_state()
+
+def schedule_ivfpq_build():
+    """Start training IVF-PQ in the background once enough vectors are staged."""
+    global ivfpq_build_task
+    if vector_store.needs_ivfpq_build() and (ivfpq_build_task is None or ivfpq_build_task.done()):
+        ivfpq_build_task = asyncio.get_running_loop().create_task(build_ivfpq_index())
+
 # -------------------- Helper: Gemini Chat -------------------------------------
+PROMPT_TMPL = (
+    "You are DocuMind — an intelligent assistant that answers questions based on PDF content.\n"
+    "Use the provided CONTEXT to answer concisely (3–5 lines max).\n"
+    "When referencing a source, include only the page number in parentheses (e.g., [Page 8]).\n"
+    "Do not include file IDs or long UUIDs in the answer.\n\n"
+    "CONTEXT:\n{ctx}\n\n"
+    "QUESTION: {q}\n\n"
+    "Answer clearly and factually."
+)
+
+@lru_cache(maxsize=1024)
 def get_gemini_response(prompt: str) -> str:
-    """Send prompt to Google Gemini and return response text."""
-    model = genai.GenerativeModel("gemini-2.5-flash")
-    response = model.generate_content(prompt)
+    """Send prompt to Google Gemini and return response text (identical prompts are cached)."""
+    response = GEMINI_MODEL.generate_content(prompt)
     return response.text.strip()
 
+# -------------------- Helper: Save Upload -------------------------------------
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+async def save_upload(file: UploadFile, path: str) -> None:
+    """Stream an uploaded file to disk in fixed-size chunks instead of reading it whole."""
+    with open(path, "wb") as f:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            f.write(chunk)
+
 # -------------------- Endpoints -----------------------------------------------
 
 @app.post("/upload_pdf")
@@ -52,31 +147,16 @@ async def upload_pdf(file: UploadFile = File(...)):
     file_id = str(uuid.uuid4())
     path = os.path.join("uploaded_pdfs", f"{file_id}.pdf")
 
-    # Save uploaded file
-    with open(path, "wb") as f:
-        content = await file.read()
-        f.write(content)
+    await save_upload(file, path) # Save uploaded file
 
     # Extract text and create embeddings
     pages = extract_text_from_pdf(path)
     chunks = chunk_texts(pages)
     texts = [c["chunk"] for c in chunks]
-    embs = embedding_manager.embed_texts(texts)
+    embs = embedding_manager.embed_texts(texts, keys=[c["hash"] for c in chunks])
 
-    # Prepare metadata for each chunk
-    metas = []
-    for c in chunks:
-        metas.append({
-            "file_id": file_id,
-            "file_name": file.filename,
-            "chunk_id": c["id"],
-            "page": c["page"],
-            "start": c["start"],
-            "end": c["end"],
-            "text_preview": c["chunk"][:250]
-        })
-
-    vector_store.add(embs, metas) # Add to vector store
+    vector_store.add(embs, file_id, chunks) # Add to vector store with chunk metadata
+    query_cache.clear()  # cached answers don't cover the new document
 
     # Track uploaded file
     UPLOADED[file_id] = {
@@ -84,6 +164,8 @@ async def upload_pdf(file: UploadFile = File(...)):
         "path": path,
         "num_chunks": len(chunks)
     }
+    save_state()
+    schedule_ivfpq_build()
 
     return {
         "file_id": file_id,
@@ -98,52 +180,65 @@ async def upload_pdfs(files: List[UploadFile] = File(...)):
     os.makedirs("uploaded_pdfs", exist_ok=True)
     uploaded = []
 
-    for file in files:
+    # Extract and chunk every PDF first so all chunks can be embedded together
+    batch = []
+    all_texts = []
+    all_keys = []
+    offsets = []  # (file_idx, start, end) slices into all_texts
+    for file_idx, file in enumerate(files):
         file_id = str(uuid.uuid4())
         path = os.path.join("uploaded_pdfs", f"{file_id}.pdf")
-        with open(path, "wb") as f:
-            content = await file.read()
-            f.write(content)
+        await save_upload(file, path)
 
         pages = extract_text_from_pdf(path)
         chunks = chunk_texts(pages)
-        texts = [c["chunk"] for c in chunks]
-        embs = embedding_manager.embed_texts(texts)
-
-        metas = []
-        for c in chunks:
-            metas.append({
-                "file_id": file_id,
-                "file_name": file.filename,
-                "chunk_id": c["id"],
-                "page": c["page"],
-                "start": c["start"],
-                "end": c["end"],
-                "text_preview": c["chunk"][:250]
-            })
-
-        vector_store.add(embs, metas)
+        start = len(all_texts)
+        all_texts.extend(c["chunk"] for c in chunks)
+        all_keys.extend(c["hash"] for c in chunks)
+        offsets.append((file_idx, start, len(all_texts)))
+        batch.append((file_id, file.filename, path, chunks))
+
+    # Single encode call across the whole upload, then split back per file
+    all_embs = embedding_manager.embed_texts(all_texts, keys=all_keys)
+
+    for file_idx, start, end in offsets:
+        file_id, filename, path, chunks = batch[file_idx]
+        embs = all_embs[start:end]
+
+        vector_store.add(embs, file_id, chunks)
 
         UPLOADED[file_id] = {
-            "filename": file.filename,
+            "filename": filename,
             "path": path,
             "num_chunks": len(chunks)
         }
 
         uploaded.append({
             "file_id": file_id,
-            "filename": file.filename,
+            "filename": filename,
             "num_chunks": len(chunks)
         })
 
+    if uploaded:
+        query_cache.clear()
+        save_state()
+        schedule_ivfpq_build()
+
     return {"uploaded": uploaded}
 
 
 @app.post("/query")
-async def query_doc(query: str = Form(...), top_k: int = Form(5)):
+async def query_doc(query: str = Form(...), top_k: int = Form(5), no_cache: bool = Form(False)):
     """Query  uploaded PDFs using embeddings and return answer with citations."""
     # Generate embedding for the query
-    q_emb = embedding_manager.embed_texts([query])[0]
+    q_emb = await query_batcher.embed(query)
+
+    # Reuse the answer of a near-identical earlier question
+    if not no_cache:
+        cached = query_cache.get(q_emb, top_k)
+        if cached is not None:
+            return cached
+
     results = vector_store.query(q_emb, top_k=top_k)
 
     if not results:
@@ -152,36 +247,26 @@ async def query_doc(query: str = Form(...), top_k: int = Form(5)):
     # Build context and track citations
     context_texts = []
     citations = []
-    seen_chunks = set()
-
-    for i, (meta, score) in enumerate(results):
-        if meta["chunk_id"] in seen_chunks:
-            continue
-        seen_chunks.add(meta["chunk_id"])
 
-        filename = UPLOADED.get(meta["file_id"], {}).get("filename", "Unknown File")
+    for i, (row, num_rows, score) in enumerate(results):
+        file_id = vector_store.file_id_at(row)
+        filename = UPLOADED.get(file_id, {}).get("filename", "Unknown File")
 
         context_texts.append(
-            f"[{i+1}] {meta['text_preview'][:250]}"
+            f"[{i+1}] {vector_store.preview_at(row)}"
         )
 
+        # Identical text in other chunks shares this vector; cite the first, count the rest
         citations.append({
             "rank": i+1,
-            "source": f"{filename} (ID: {meta['file_id']})",
-            "page": meta["page"],
-            "score": float(score)
+            "source": f"{filename} (ID: {file_id})",
+            "page": int(vector_store.page[row]),
+            "score": float(score),  # cosine similarity, higher is better
+            "duplicates": num_rows - 1
         })
 
     # Prepare prompt for Gemini with context
-    prompt = (
-        "You are DocuMind — an intelligent assistant that answers questions based on PDF content.\n"
-        "Use the provided CONTEXT to answer concisely (3–5 lines max).\n"
-        "When referencing a source, include only the page number in parentheses (e.g., [Page 8]).\n"
-        "Do not include file IDs or long UUIDs in the answer.\n\n"
-        f"CONTEXT:\n{chr(10).join(context_texts)}\n\n"
-        f"QUESTION: {query}\n\n"
-        "Answer clearly and factually."
-    )
+    prompt = PROMPT_TMPL.format(ctx="\n".join(context_texts), q=query)
 
     # Get answer from Gemini
     try:
@@ -189,5 +274,9 @@ async def query_doc(query: str = Form(...), top_k: int = Form(5)):
     except Exception as e:
         # Fallback in case LLM call fails
         answer = "LLM call failed: " + str(e) + "\n\nContext provided:\n" + "\n".join(context_texts)
+        return {"answer": answer, "citations": citations}
 
-    return {"answer": answer, "citations": citations}
\ No newline at end of file
+    response = {"answer": answer, "citations": citations}
+    if not no_cache:
+        query_cache.put(q_emb, query, top_k, response)
+    return response
\ No newline at end of file
@@ -1,10 +1,57 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
 import fitz  # PyMuPDF
 
+PAGES_PER_WORKER = 64  # a worker process is only worth it for at least this many pages
+_pool = None
+
+def _get_pool():
+    """Return the shared extraction pool, creating it on first use.
+
+    Workers are spawned rather than forked: the server process already runs torch
+    threads and the asyncio loop, and forking a multithreaded process can deadlock.
+    """
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count() or 1,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+def _extract_page_range(args):
+    """Extract text of pages [start, end) in a worker process with its own document handle."""
+    file_path, start, end = args
+    with fitz.open(file_path) as doc:
+        return [doc.load_page(i).get_text() for i in range(start, end)]
+
+def _extract_parallel(ranges):
+    """Extract page ranges on the shared pool, replacing it once if a worker died."""
+    global _pool
+    for attempt in range(2):
+        try:
+            return [t for part in _get_pool().map(_extract_page_range, ranges) for t in part]
+        except BrokenProcessPool:
+            _pool = None  # a crashed worker breaks the whole executor; start a fresh one
+            if attempt:
+                raise
+
 def extract_text_from_pdf(file_path):
     """Extract text from each page of a PDF as a list of dictionaries."""
-    doc = fitz.open(file_path)
-    pages = []
-    for i, page in enumerate(doc):
-        text = page.get_text()
-        pages.append({"page_num": i+1, "text": text})
-    return pages
+    with fitz.open(file_path) as doc:
+        n = doc.page_count
+        # Parallel only when at least two workers each get PAGES_PER_WORKER pages
+        workers = min(os.cpu_count() or 1, n // PAGES_PER_WORKER)
+        if workers <= 1:
+            texts = [page.get_text() for page in doc]
+
+    if workers > 1:
+        # PyMuPDF is not thread-safe, so split the pages across processes instead
+        step = -(-n // workers)
+        ranges = [(file_path, s, min(s + step, n)) for s in range(0, n, step)]
+        texts = _extract_parallel(ranges)
+
+    return [{"page_num": i+1, "text": t} for i, t in enumerate(texts)]
@@ -1,20 +1,34 @@
-import uuid
+from hashlib import blake2b
+
+import numpy as np
+
+def text_hash(text):
+    """64-bit content hash of a chunk's text, shared by the embedding cache and the vector store."""
+    return int.from_bytes(blake2b(text.encode(), digest_size=8).digest(), "little", signed=True)
+
+def _compute_offsets(lengths, chunk_size, overlap):
+    """Return (page index, start, end) arrays for every chunk of pages with the given text lengths."""
+    stride = chunk_size - overlap
+    counts = -(-lengths // stride)  # chunks per page, 0 for empty pages
+    page_idx = np.repeat(np.arange(len(lengths)), counts)
+    first = np.cumsum(counts) - counts  # position of each page's first chunk
+    starts = (np.arange(counts.sum()) - first[page_idx]) * stride
+    ends = np.minimum(starts + chunk_size, lengths[page_idx])
+    return page_idx, starts, ends
 
 def chunk_texts(pages, chunk_size=500, overlap=50):
-    """Split PDF pages into overlapping text chunks with unique IDs."""
+    """Split PDF pages into overlapping text chunks with sequential per-document IDs and content hashes."""
+    lengths = np.fromiter((len(page["text"]) for page in pages), np.int64, len(pages))
+    page_idx, starts, ends = _compute_offsets(lengths, chunk_size, overlap)
     chunks = []
-    for page in pages:
-        text = page["text"]
-        start = 0
-        while start < len(text):
-            end = min(start + chunk_size, len(text))
-            chunk_text = text[start:end]
-            chunks.append({
-                "id": str(uuid.uuid4()),
-                "page": page["page_num"],
-                "start": start,
-                "end": end,
-                "chunk": chunk_text
-            })
-            start += chunk_size - overlap
+    for i, (p, s, e) in enumerate(zip(page_idx.tolist(), starts.tolist(), ends.tolist())):
+        chunk_text = pages[p]["text"][s:e]
+        chunks.append({
+            "id": i,
+            "page": pages[p]["page_num"],
+            "start": s,
+            "end": e,
+            "chunk": chunk_text,
+            "hash": text_hash(chunk_text)
+        })
     return chunks
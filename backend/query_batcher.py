@@ -0,0 +1,53 @@
+import asyncio
+
+class QueryBatcher:
+    """Coalesces concurrent query embeddings into a single encode call."""
+
+    def __init__(self, embedding_manager, max_wait=0.01, max_size=32):
+        """Initialize the batcher; call start() from a running event loop."""
+        self.embedding_manager = embedding_manager
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.queue = None
+        self._task = None
+
+    def start(self):
+        """Create the queue and launch the background batching task."""
+        self.queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def embed(self, query):
+        """Return the embedding of a single query, batched with any concurrent ones."""
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, fut))
+        return await fut
+
+    async def _drain(self):
+        """Wait for one query, then collect more until max_wait elapses or max_size is reached."""
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        """Embed each drained batch in one forward pass and resolve its futures."""
+        while True:
+            batch = await self._drain()
+            try:
+                embs = self.embedding_manager.embed_texts([q for q, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            for (_, fut), emb in zip(batch, embs):
+                if not fut.done():
+                    fut.set_result(emb)
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+
+import faiss
+import numpy as np
+
+class SemanticQueryCache:
+    """LRU cache of /query responses looked up by cosine similarity of query embeddings."""
+
+    def __init__(self, dim, threshold=0.95, max_entries=256, neighbours=8):
+        """Initialize an inner-product index over cached query embeddings."""
+        self.dim = dim
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.neighbours = neighbours
+        self.index = faiss.IndexIDMap(faiss.IndexFlatIP(dim))
+        self.entries = OrderedDict()  # entry id -> (query, top_k, response)
+        self._next_id = 0
+
+    def _as_query(self, query_emb):
+        """Return the query embedding as a normalized (1, dim) float32 array."""
+        q = np.array(query_emb, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(q)
+        return q
+
+    def get(self, query_emb, top_k):
+        """Return the cached response for a near-identical query, or None on a miss."""
+        if not self.entries:
+            return None
+        # Check a few neighbours: the nearest may be the same question with a different top_k
+        k = min(self.neighbours, len(self.entries))
+        D, I = self.index.search(self._as_query(query_emb), k)
+        for entry_id, score in zip(I[0].tolist(), D[0]):
+            if entry_id < 0 or score < self.threshold:
+                break  # results are sorted by similarity
+            _, cached_top_k, response = self.entries[entry_id]
+            if cached_top_k == top_k:
+                self.entries.move_to_end(entry_id)
+                return response
+        return None
+
+    def put(self, query_emb, query, top_k, response):
+        """Cache a response, evicting the least recently used entry when full."""
+        if len(self.entries) >= self.max_entries:
+            old_id, _ = self.entries.popitem(last=False)
+            self.index.remove_ids(np.array([old_id], dtype=np.int64))
+        entry_id = self._next_id
+        self._next_id += 1
+        self.index.add_with_ids(self._as_query(query_emb), np.array([entry_id], dtype=np.int64))
+        self.entries[entry_id] = (query, top_k, response)
+
+    def clear(self):
+        """Drop all cached responses (e.g. after new documents are indexed)."""
+        self.index.reset()
+        self.entries.clear()
@@ -1,27 +1,194 @@
+import os
+import pickle
+
 import faiss
 import numpy as np
 
+PREVIEW_LEN = 250  # characters of chunk text kept for prompts
+IVF_NLIST = 1024
+IVF_TRAIN_MIN = 39 * IVF_NLIST  # FAISS' recommended minimum training points for k-means
+META_COLUMNS = (
+    "file_id_of_idx", "file_idx_per_row",
+    "chunk_id", "page", "start", "end", "preview_buf", "preview_span", "text_hash",
+    "row_vector", "vector_first_row",
+)
+
+def _append_column(column, values, count):
+    """Return a numpy metadata column extended with count values."""
+    return np.concatenate([column, np.fromiter(values, column.dtype, count)])
+
+def train_ivfpq(vectors):
+    """Train IVF-PQ on a bounded sample of vectors and add all of them; CPU-heavy, run off the event loop."""
+    index = faiss.index_factory(vectors.shape[1], f"IVF{IVF_NLIST},PQ32", faiss.METRIC_INNER_PRODUCT)
+    faiss.extract_index_ivf(index).nprobe = 16
+    sample = vectors
+    if len(vectors) > IVF_TRAIN_MIN:
+        sample = vectors[np.random.default_rng(0).choice(len(vectors), IVF_TRAIN_MIN, replace=False)]
+    index.train(sample)
+    index.add(vectors)
+    return index
+
 class FaissVectorStore:
     """Simple FAISS-based vector store for adding and querying embeddings."""
 
-    def __init__(self, dim):
-        """Initialize a FAISS L2 index with given embedding dimension."""
+    def __init__(self, dim, index_type="hnsw"):
+        """Initialize a FAISS inner-product index ("flat", "hnsw" or "ivfpq") with given embedding dimension."""
         self.dim = dim
-        self.index = faiss.IndexFlatL2(dim)
-        self.metas = []
+        self.index_type = index_type
+        if index_type == "flat":
+            self.index = faiss.IndexFlatIP(dim)
+        elif index_type == "hnsw":
+            self.index = faiss.IndexHNSWFlat(dim, 32, faiss.METRIC_INNER_PRODUCT)
+            self.index.hnsw.efConstruction = 200
+            self.index.hnsw.efSearch = 64
+        elif index_type == "ivfpq":
+            # For 100k+ chunks; vectors are staged in a flat index until the app trains IVF-PQ
+            self.index = faiss.IndexFlatIP(dim)
+        else:
+            raise ValueError(f"Unknown index type: {index_type}")
+        # FAISS has no GPU HNSW; flat and IVF-PQ move to GPU when one is visible
+        self.on_gpu = index_type != "hnsw" and faiss.get_num_gpus() > 0
+        self.index = self._to_gpu(self.index)
+        self.staging = index_type == "ivfpq"
+
+        # Per-row metadata as parallel columns indexed by FAISS row id.
+        # File ids are interned per file; previews share one UTF-8 buffer.
+        self.file_id_of_idx = []
+        self._file_idx = {}  # file_id -> index into file_id_of_idx
+        self.file_idx_per_row = np.empty(0, dtype=np.int32)
+        self.chunk_id = np.empty(0, dtype=np.int64)
+        self.page = np.empty(0, dtype=np.int32)
+        self.start = np.empty(0, dtype=np.int64)
+        self.end = np.empty(0, dtype=np.int64)
+        self.preview_buf = bytearray()
+        self.preview_span = np.empty((0, 2), dtype=np.int64)  # (offset, length) into preview_buf
+        self.text_hash = np.empty(0, dtype=np.int64)
+
+        # One vector per distinct chunk text: rows map to vectors and back
+        self.row_vector = np.empty(0, dtype=np.int64)  # vector id of each row
+        self.vector_first_row = np.empty(0, dtype=np.int64)  # row that first added each vector
+        self._dup_rows = {}  # vector id -> later rows with the same text
+        self._hash_vector = {}  # text hash -> vector id
+
+    def _to_gpu(self, index):
+        """Move a CPU index onto all visible GPUs if this store runs on GPU."""
+        return faiss.index_cpu_to_all_gpus(index) if self.on_gpu else index
+
+    def needs_ivfpq_build(self):
+        """True once enough vectors are staged to train the IVF-PQ index."""
+        return self.staging and self.index.ntotal >= IVF_TRAIN_MIN
+
+    def staged_vectors(self):
+        """Copy of the vectors staged so far, in row order, to pass to train_ivfpq()."""
+        return self.index.reconstruct_n(0, self.index.ntotal)
 
-    def add(self, embeddings, metas):
-        """Add embeddings and their metadata to the index."""
-        embs_np = np.array(embeddings).astype("float32")
-        self.index.add(embs_np)
-        self.metas.extend(metas)
+    def swap_in_ivfpq(self, index):
+        """Replace the staging index with a trained IVF-PQ one, adding vectors staged since the snapshot."""
+        n = index.ntotal
+        if self.index.ntotal > n:
+            index.add(self.index.reconstruct_n(n, self.index.ntotal - n))
+        self.index = self._to_gpu(index)
+        self.staging = False
+
+    def __len__(self):
+        """Number of stored chunks."""
+        return len(self.file_idx_per_row)
+
+    def file_id_at(self, row):
+        """File id of the chunk stored at row."""
+        return self.file_id_of_idx[self.file_idx_per_row[row]]
+
+    def preview_at(self, row):
+        """Text preview of the chunk stored at row."""
+        offset, length = self.preview_span[row]
+        return self.preview_buf[offset:offset + length].decode()
+
+    def add(self, embeddings, file_id, chunks):
+        """Add one file's chunks and their metadata; chunks whose text is already indexed reuse its vector."""
+        n = len(chunks)
+        hashes = [c["hash"] for c in chunks]
+        row_vector = np.empty(n, dtype=np.int64)
+        new_vectors, keep = {}, []  # hash -> new vector id, positions to embed
+        for i, h in enumerate(hashes):
+            vid = self._hash_vector.get(h, new_vectors.get(h))
+            if vid is None:
+                vid = self.index.ntotal + len(keep)
+                new_vectors[h] = vid
+                keep.append(i)
+            row_vector[i] = vid
+
+        if keep:
+            embs_np = np.ascontiguousarray(np.asarray(embeddings)[keep], dtype=np.float32)
+            faiss.normalize_L2(embs_np)  # unit vectors: inner product == cosine similarity
+            self.index.add(embs_np)
+        self._hash_vector.update(new_vectors)  # only once the vectors are actually indexed
+
+        # Every chunk gets a metadata row; rows of repeated text point at the existing vector
+        first_row = len(self)
+        self.vector_first_row = _append_column(self.vector_first_row, (first_row + i for i in keep), len(keep))
+        for i, vid in enumerate(row_vector.tolist()):
+            if self.vector_first_row[vid] != first_row + i:
+                self._dup_rows.setdefault(vid, []).append(first_row + i)
+        self.row_vector = np.concatenate([self.row_vector, row_vector])
+
+        if file_id not in self._file_idx:
+            self._file_idx[file_id] = len(self.file_id_of_idx)
+            self.file_id_of_idx.append(file_id)
+        self.file_idx_per_row = np.concatenate(
+            [self.file_idx_per_row, np.full(n, self._file_idx[file_id], dtype=np.int32)]
+        )
+        self.chunk_id = _append_column(self.chunk_id, (c["id"] for c in chunks), n)
+        self.page = _append_column(self.page, (c["page"] for c in chunks), n)
+        self.start = _append_column(self.start, (c["start"] for c in chunks), n)
+        self.end = _append_column(self.end, (c["end"] for c in chunks), n)
+        spans = np.empty((n, 2), dtype=np.int64)
+        for i, c in enumerate(chunks):
+            preview = c["chunk"][:PREVIEW_LEN].encode()
+            spans[i] = (len(self.preview_buf), len(preview))
+            self.preview_buf += preview
+        self.preview_span = np.concatenate([self.preview_span, spans])
+        self.text_hash = _append_column(self.text_hash, hashes, n)
 
     def query(self, query_emb, top_k=5):
-        """Return top-k nearest embeddings and their metadata for a query vector."""
-        query_np = np.array([query_emb]).astype("float32")
+        """Return (first row, number of rows sharing the vector, cosine similarity) for the top-k most similar vectors."""
+        query_np = np.ascontiguousarray(query_emb, dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(query_np)
+        if not self.index.is_trained or self.index.ntotal == 0:
+            return []
         D, I = self.index.search(query_np, top_k)
         results = []
         for i, score in zip(I[0], D[0]):
-            if i < len(self.metas):
-                results.append((self.metas[i], score))
+            if 0 <= i < len(self.vector_first_row):
+                results.append((int(self.vector_first_row[i]), 1 + len(self._dup_rows.get(i, ())), score))
         return results
+
+    def save(self, path):
+        """Write the index to path.faiss and its metadata to path.meta."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        index = faiss.index_gpu_to_cpu(self.index) if self.on_gpu else self.index
+        # Write to temp files and rename so a crash never leaves a half-written file
+        faiss.write_index(index, path + ".faiss.tmp")
+        with open(path + ".meta.tmp", "wb") as f:
+            columns = {name: getattr(self, name) for name in META_COLUMNS}
+            pickle.dump({"index_type": self.index_type, "staging": self.staging, "columns": columns}, f)
+        os.replace(path + ".faiss.tmp", path + ".faiss")
+        os.replace(path + ".meta.tmp", path + ".meta")
+
+    @classmethod
+    def load(cls, path):
+        """Restore a vector store written by save()."""
+        index = faiss.read_index(path + ".faiss")
+        with open(path + ".meta", "rb") as f:
+            state = pickle.load(f)
+        store = cls(index.d, index_type=state["index_type"])
+        store.index = store._to_gpu(index)
+        store.staging = state["staging"]
+        for name, column in state["columns"].items():
+            setattr(store, name, column)
+        for row, (h, vid) in enumerate(zip(store.text_hash.tolist(), store.row_vector.tolist())):
+            if store.vector_first_row[vid] == row:
+                store._hash_vector[h] = vid
+            else:
+                store._dup_rows.setdefault(vid, []).append(row)
+        store._file_idx = {fid: i for i, fid in enumerate(store.file_id_of_idx)}
+        return store